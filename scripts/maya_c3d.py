@@ -38,7 +38,7 @@ __status__ = "Development"
 
 
 ## FUNCTIONS
-def print_skeleton():
+def print_skeleton(root):
     '''
     Prints skeleton.
     '''
@@ -59,20 +59,22 @@ def c3d_callback(*arg):
     
     c3d2trc_func([c3d_path])
     
-    _, data = df_from_trc(trc_path)
-    labels, str_cnt, rangeFrames = analyze_data(data)
+    labels, str_cnt, rangeFrames, data_np, col_of = load_trc(trc_path)
     cmds.group(empty=True, name='C3D'+str_cnt)
     
     markers_check = cmds.checkBox(markers_box, query=True, value=True)
-    if markers_check == True:
-        set_markers(data, labels, rangeFrames)
-        cmds.group(cmds.ls(labels), n='markers'+str_cnt)
-        cmds.parent('markers'+str_cnt, 'C3D'+str_cnt)
-
     skeleton_check = cmds.checkBox(skeleton_box, query=True, value=True)
-    if skeleton_check == True:
-        set_skeleton(data, str_cnt, rangeFrames)
-        cmds.parent(root+str_cnt, 'C3D'+str_cnt)
+    with suspended_scene_updates():
+        if markers_check == True:
+            markers = set_markers(data_np, labels, rangeFrames)
+            cmds.group(markers, n='markers'+str_cnt)
+            cmds.parent('markers'+str_cnt, 'C3D'+str_cnt)
+
+        if skeleton_check == True:
+            skel = cmds.optionMenu(skeleton_choice, query=True, value=True)
+            root, skel_order = load_skeleton(skel)
+            set_skeleton(data_np, col_of, root, skel_order, str_cnt, rangeFrames)
+            cmds.parent(root.name+str_cnt, 'C3D'+str_cnt)
         
     cmds.playbackOptions(minTime=rangeFrames[0], maxTime=rangeFrames[-1])
     cmds.playbackOptions(playbackSpeed = 1)
@@ -83,12 +85,11 @@ def skel_callback(*args):
     Inputs skeleton choice 
     Prints skeleton hierarchy
     '''
-    global root
     cmds.checkBox(skeleton_box, edit=True, value=True)
     skel = cmds.optionMenu(skeleton_choice, query=True, value=True)
-    root = eval('skeletons_config.root_'+skel)
+    root, _ = load_skeleton(skel)
     print('# Skeleton ' + skel.upper() + ' #')
-    print_skeleton()
+    print_skeleton(root)
     
 
 ## WINDOW CREATION
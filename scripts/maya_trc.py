@@ -8,7 +8,6 @@
     ##################################################
     
     Choose if you only want to display the markers, or also to construct the skeleton.
-    See "set_skeleton" function if the bones are not connecting the joints properly.
     
     If you want to use your own custom skeleton hierarchy, please edit the file "skeletons_config.py"
     Your joint names should be your trc labels + letter J.
@@ -18,9 +17,14 @@
 
 ## INIT
 import maya.cmds as cmds
+import maya.api.OpenMaya as om
+import maya.api.OpenMayaAnim as oma
 import numpy as np
 import pandas as pd
+import io
 import re
+import gc
+from contextlib import contextmanager
 from anytree import Node, RenderTree
 import skeletons_config
 from imp import reload
@@ -39,21 +43,49 @@ __status__ = "Development"
 
 
 ## FUNCTIONS
+@contextmanager
+def suspended_scene_updates():
+    '''
+    Disable undo queue, viewport refresh and evaluation manager during bulk scene edits
+    Evaluation manager is then set to parallel mode for playback from Maya 2022,
+    and left to DG in older versions to make sure bones are connecting the joints
+    '''
+    undo_state = cmds.undoInfo(query=True, state=True)
+    cmds.undoInfo(stateWithoutFlush=False)
+    cmds.refresh(suspend=True)
+    cmds.evaluationManager(mode='off')
+    try:
+        yield
+    finally:
+        if cmds.about(apiVersion=True) >= 20220000:
+            cmds.evaluationManager(mode='parallel')
+        cmds.refresh(suspend=False)
+        cmds.undoInfo(stateWithoutFlush=undo_state)
+        cmds.refresh(force=True)
+
+
 def df_from_trc(trc_path):
     '''
     Retrieve header and data from trc
     '''
-    # DataRate	CameraRate	NumFrames	NumMarkers	Units	OrigDataRate	OrigDataStartFrame	OrigNumFrames
-    df_header = pd.read_csv(trc_path, sep="\t", skiprows=1, header=None, nrows=2, encoding="ISO-8859-1")
-    header = dict(zip(df_header.iloc[0].tolist(), df_header.iloc[1].tolist()))
-    
-    # Label1_X  Label1_Y    Label1_Z    Label2_X    Label2_Y
-    df_lab = pd.read_csv(trc_path, sep="\t", skiprows=3, nrows=1)
-    labels = df_lab.columns.tolist()[2:-1:3]
-    labels_XYZ = np.array([[labels[i]+'_X', labels[i]+'_Y', labels[i]+'_Z'] for i in range(len(labels))], dtype='object').flatten()
-    labels_FTXYZ = np.concatenate((['Frame#','Time'], labels_XYZ))
-    
-    data = pd.read_csv(trc_path, sep="\t", skiprows=5, index_col=False, header=None, names=labels_FTXYZ)
+    with io.open(trc_path, 'r', encoding="ISO-8859-1") as trc_file:
+        trc_file.readline() # PathFileType
+        
+        # DataRate	CameraRate	NumFrames	NumMarkers	Units	OrigDataRate	OrigDataStartFrame	OrigNumFrames
+        header_keys = trc_file.readline().rstrip('\r\n').split('\t')
+        header_values = trc_file.readline().rstrip('\r\n').split('\t')
+        header = dict(zip(header_keys, header_values))
+        
+        # Frame#	Time	Label1			Label2
+        labels = [l for l in trc_file.readline().rstrip('\r\n').split('\t')[2::3] if l.strip()]
+        labels_XYZ = [l+'_'+axis for l in labels for axis in ('X','Y','Z')]
+        labels_FTXYZ = ['Frame#','Time'] + labels_XYZ
+        trc_file.readline() # X1	Y1	Z1	X2
+        
+        # Coordinates are not more precise than float32
+        col_dtypes = dict.fromkeys(labels_FTXYZ, np.float32)
+        col_dtypes['Frame#'] = np.int64
+        data = pd.read_csv(trc_file, sep="\t", index_col=False, header=None, names=labels_FTXYZ, dtype=col_dtypes, engine='c')
     
     return header, data
     
@@ -62,12 +94,14 @@ def increment_labels(labels):
     '''
     Increment label names in case of previous trc importations
     '''
-    objs = cmds.ls(type='transform')
-    cnt=1 
-    for l in labels:
-        if l+str(cnt) in objs or l+'J'+str(cnt) in objs:
-            cnt+=1
-            continue
+    objs = set(obj.split('|')[-1] for obj in cmds.ls(type='transform'))
+    pattern = re.compile(r'^(' + '|'.join(re.escape(l) for l in labels) + r')J?(\d+)$')
+    used = set()
+    for obj in objs:
+        match = pattern.match(obj)
+        if match:
+            used.add(int(match.group(2)))
+    cnt = max(used)+1 if used else 1
     str_cnt = str(cnt)
     labels_cnt = [l+str_cnt for l in labels]
     
@@ -85,28 +119,84 @@ def analyze_data(data):
     
     return labels, str_cnt, rangeFrames
 
+
+def load_trc(trc_path):
+    '''
+    Read trc file and analyze its data
+    Only keep coordinates (without Frame# and Time columns) as a numpy array,
+    and a dictionary mapping coordinate labels to their column
+    '''
+    _, data = df_from_trc(trc_path)
+    labels, str_cnt, rangeFrames = analyze_data(data)
+    data_np = data.iloc[:, 2:].to_numpy()
+    col_of = {c: i for i, c in enumerate(data.columns[2:])}
+    del data # release DataFrame before building the scene
+    gc.collect()
     
-def set_markers(data, labels, rangeFrames):
+    return labels, str_cnt, rangeFrames, data_np, col_of
+
+
+def key_plug(node, attr, times, values):
     '''
-    Set markers from trc
+    Key an attribute on all frames at once with a single animation curve
+    Node is a node name or an MObject, values are given in scene units
     '''
+    if not isinstance(node, om.MObject):
+        sel = om.MSelectionList()
+        sel.add(node)
+        node = sel.getDependNode(0)
+    plug = om.MFnDependencyNode(node).findPlug(attr, False)
+    unit_factor = om.MDistance(1.0, om.MDistance.uiUnit()).asUnits(om.MDistance.internalUnit())
+    values = om.MDoubleArray((np.asarray(values, dtype=np.float64) * unit_factor).tolist())
     
-    # Create markers
-    for j in range(len(labels)):
-        if j==0:
-            cmds.polySphere(r=.03, sx=20, sy=20, n=labels[j])
-        else:
-            cmds.instance(labels[0], n=labels[j])
-    # Place markers
-    firstFrame = rangeFrames[0]
-    for i in rangeFrames:
-        for j in range(len(labels)):
-            cmds.setKeyframe(labels[j], t=i, at='translateX', v=data.iloc[i-firstFrame,3*j+2 +2])
-            cmds.setKeyframe(labels[j], t=i, at='translateY', v=data.iloc[i-firstFrame,3*j +2])
-            cmds.setKeyframe(labels[j], t=i, at='translateZ', v=data.iloc[i-firstFrame,3*j+1 +2])
+    curve = oma.MFnAnimCurve()
+    curve.create(plug, oma.MFnAnimCurve.kAnimCurveTL)
+    curve.addKeys(times, values, oma.MFnAnimCurve.kTangentAuto, oma.MFnAnimCurve.kTangentAuto)
 
     
-def print_skeleton():
+def set_markers(data_np, labels, rangeFrames):
+    '''
+    Set markers from trc coordinates (data without Frame# and Time columns)
+    Returns created marker names
+    '''
+    
+    # Create markers (other markers are instances of the first sphere shape)
+    sphere = cmds.polySphere(r=.03, sx=20, sy=20, n=labels[0])[0]
+    sel = om.MSelectionList()
+    sel.add(sphere)
+    sphere_shape = sel.getDagPath(0).extendToShape().node()
+    dag_mod = om.MDagModifier()
+    transforms = [dag_mod.createNode('transform') for _ in labels[1:]]
+    for transform, label in zip(transforms, labels[1:]):
+        dag_mod.renameNode(transform, label)
+    dag_mod.doIt()
+    
+    # Instance and place markers one at a time (one animation curve per marker axis)
+    times = om.MTimeArray([om.MTime(i, om.MTime.uiUnit()) for i in rangeFrames])
+    created_names = []
+    for j, marker in enumerate([sel.getDependNode(0)] + transforms):
+        if j > 0:
+            om.MFnDagNode(marker).addChild(sphere_shape, om.MFnDagNode.kNextPos, True)
+        key_plug(marker, 'translateX', times, data_np[:,3*j+2])
+        key_plug(marker, 'translateY', times, data_np[:,3*j])
+        key_plug(marker, 'translateZ', times, data_np[:,3*j+1])
+        created_names.append(om.MFnDagNode(marker).name())
+    
+    return created_names
+
+    
+def load_skeleton(skel):
+    '''
+    Get skeleton root from skeletons_config
+    and (joint, parent) names in hierarchy order
+    '''
+    root = eval('skeletons_config.root_'+skel)
+    skel_order = [(node.name, node.parent.name if node.parent else None) for _, _, node in RenderTree(root)]
+    
+    return root, skel_order
+
+    
+def print_skeleton(root):
     '''
     Prints skeleton.
     '''
@@ -114,48 +204,57 @@ def print_skeleton():
         print("%s%s" % (pre, node.name))
 
     
-def set_skeleton(data, str_cnt, rangeFrames):
+def set_skeleton(data_np, col_of, root, skel_order, str_cnt, rangeFrames):
     '''
-    Set skeleton from trc
+    Set skeleton from trc coordinates (data without Frame# and Time columns)
+    col_of maps coordinate labels to their column in data_np
+    root and skel_order come from load_skeleton
     In case you're not using the model body_25b from openpose, you need to modify the section SKELETON DEFINITION
-    If bones are not connecting the joints, uncomment the last line of the function (evaluation manager mode ON)
     '''
     # Create joints
     cmds.select(None)
-    skel_callback()
     
     cmds.joint(name = root.name+str_cnt)
-    for _, _, node in RenderTree(root):    
-        if node.name != root.name:
-            cmds.select(node.parent.name+str_cnt)
-            cmds.joint(name = node.name+str_cnt)
-    cmds.select('CHipJ'+str_cnt, hi=True)
-    jointsJ = cmds.ls(sl=1)
+    for name, parent in skel_order[1:]:
+        cmds.select(parent+str_cnt)
+        cmds.joint(name = name+str_cnt)
+    jointsJ = [name+str_cnt for name, _ in skel_order]
+    parent_of_jnt = {name+str_cnt: parent+str_cnt for name, parent in skel_order[1:]}
     
     # Place and orient joints
-    firstFrame = rangeFrames[0]
-    for i in rangeFrames:
-        for j in range(len(jointsJ)): # place joints
-            if j == 0 and not root.name[:-1] in data.columns: #If model has no root, take midpoint of hips
-                RHip, LHip = root.children[0].name[:-1], root.children[1].name[:-1]
-                jointCoordX = np.add(data.loc[i-firstFrame,RHip+'_Z'], data.loc[i-firstFrame,LHip+'_Z']) / 2
-                jointCoordY = np.add(data.loc[i-firstFrame,RHip+'_X'], data.loc[i-firstFrame,LHip+'_X']) / 2
-                jointCoordZ = np.add(data.loc[i-firstFrame,RHip+'_Y'], data.loc[i-firstFrame,LHip+'_Y']) / 2
-            else:
-                jnt =  re.sub(r'[0-9]', '', jointsJ[j])[:-1] # take off numbers + letter J from joint name
-                jointCoordX = data.loc[i-firstFrame,jnt+'_Z']
-                jointCoordY = data.loc[i-firstFrame,jnt+'_X']
-                jointCoordZ = data.loc[i-firstFrame,jnt+'_Y']
-            cmds.move(jointCoordX, jointCoordY, jointCoordZ, jointsJ[j], a=True)
-            cmds.setKeyframe(jointsJ[j], t=i)
-        if i == firstFrame:  # orient joints
-            for j in range(1,len(jointsJ)):
-                cmds.joint(cmds.listRelatives(jointsJ[j], parent=True), e=True, zso=True, oj='xyz', sao='yup')
-                cmds.setKeyframe(jointsJ[j], t=i)
-
-    '''Evaluation mode to DG to make sure bones are connecting the joints (not needed in Maya 2022).
-    Change it in Windows -> Settings/Preferences -> Preferences -> Animation -> Evaluation mode -> DG'''
-    cmds.evaluationManager(mode="off")
+    name_to_col = dict(col_of)
+    joint_labels = [name[:-1] for name, _ in skel_order] # take off letter J from joint names
+    if not joint_labels[0]+'_X' in name_to_col: #If model has no root, take midpoint of hips
+        RHip, LHip = root.children[0].name[:-1], root.children[1].name[:-1]
+        RHip_cols = [name_to_col[RHip+'_'+axis] for axis in 'XYZ']
+        LHip_cols = [name_to_col[LHip+'_'+axis] for axis in 'XYZ']
+        data_np = np.column_stack((data_np, (data_np[:,RHip_cols] + data_np[:,LHip_cols]) * 0.5))
+        for k, axis in enumerate('XYZ'):
+            name_to_col[joint_labels[0]+'_'+axis] = data_np.shape[1]-3+k
+    col_idx = np.array([[name_to_col[l+'_Z'], name_to_col[l+'_X'], name_to_col[l+'_Y']] for l in joint_labels])
+    
+    coords = data_np[:, col_idx] # (frames, joints, xyz) world coordinates
+    
+    # Place joints on first frame and orient them
+    for j in range(len(jointsJ)):
+        cmds.move(coords[0,j,0], coords[0,j,1], coords[0,j,2], jointsJ[j], a=True)
+    for j in range(1,len(jointsJ)):
+        cmds.joint(parent_of_jnt[jointsJ[j]], e=True, zso=True, oj='xyz', sao='yup')
+    
+    # Key joint translations (one animation curve per joint axis)
+    # Joints are never rotated, so the world orientation of each parent is fixed once oriented
+    jnt_index = {jnt: j for j, jnt in enumerate(jointsJ)}
+    times = om.MTimeArray([om.MTime(i, om.MTime.uiUnit()) for i in rangeFrames])
+    for j in range(len(jointsJ)):
+        if j == 0:
+            local_coords = coords[:,0]
+        else:
+            parent = parent_of_jnt[jointsJ[j]]
+            parent_rot = np.array(cmds.xform(parent, query=True, worldSpace=True, matrix=True)).reshape(4,4)[:3,:3]
+            local_coords = (coords[:,j] - coords[:,jnt_index[parent]]).dot(np.linalg.inv(parent_rot))
+        key_plug(jointsJ[j], 'translateX', times, local_coords[:,0])
+        key_plug(jointsJ[j], 'translateY', times, local_coords[:,1])
+        key_plug(jointsJ[j], 'translateZ', times, local_coords[:,2])
 
 def trc_callback(*arg):
     '''
@@ -166,20 +265,22 @@ def trc_callback(*arg):
     filter = "Trc files (*.trc);; All Files (*.*)"
     trc_path = cmds.fileDialog2(fileFilter=filter, dialogStyle=2, cap="Open File", fm=1)[0]
     
-    _, data = df_from_trc(trc_path)
-    labels, str_cnt, rangeFrames = analyze_data(data)
+    labels, str_cnt, rangeFrames, data_np, col_of = load_trc(trc_path)
     cmds.group(empty=True, name='TRC'+str_cnt)
     
     markers_check = cmds.checkBox(markers_box, query=True, value=True)
-    if markers_check == True:
-        set_markers(data, labels, rangeFrames)
-        cmds.group(cmds.ls(labels), n='markers'+str_cnt)
-        cmds.parent('markers'+str_cnt, 'TRC'+str_cnt)
-
     skeleton_check = cmds.checkBox(skeleton_box, query=True, value=True)
-    if skeleton_check == True:
-        set_skeleton(data, str_cnt, rangeFrames)
-        cmds.parent(root.name+str_cnt, 'TRC'+str_cnt)
+    with suspended_scene_updates():
+        if markers_check == True:
+            markers = set_markers(data_np, labels, rangeFrames)
+            cmds.group(markers, n='markers'+str_cnt)
+            cmds.parent('markers'+str_cnt, 'TRC'+str_cnt)
+
+        if skeleton_check == True:
+            skel = cmds.optionMenu(skeleton_choice, query=True, value=True)
+            root, skel_order = load_skeleton(skel)
+            set_skeleton(data_np, col_of, root, skel_order, str_cnt, rangeFrames)
+            cmds.parent(root.name+str_cnt, 'TRC'+str_cnt)
         
     cmds.playbackOptions(minTime=rangeFrames[0], maxTime=rangeFrames[-1])
     cmds.playbackOptions(playbackSpeed = 1)
@@ -190,12 +291,11 @@ def skel_callback(*args):
     Inputs skeleton choice 
     Prints skeleton hierarchy
     '''
-    global root
     cmds.checkBox(skeleton_box, edit=True, value=True)
     skel = cmds.optionMenu(skeleton_choice, query=True, value=True)
-    root = eval('skeletons_config.root_'+skel)
+    root, _ = load_skeleton(skel)
     print('# Skeleton ' + skel.upper() + ' #')
-    print_skeleton()
+    print_skeleton(root)
 
    
 ## WINDOW CREATION